@@ -3,19 +3,40 @@
 # (c) 2016-2021 Mantas Mikulėnas <grawity@gmail.com>
 # Released under the MIT License
 import argparse
-import ipaddress
+import collections
+import concurrent.futures
 import json
 import os
+import pickle
 import re
+import socket
 import time
 import sys
 import subprocess
+import tempfile
 
 try:
     import MySQLdb
 except ImportError:
     import mysql.connector as MySQLdb
 
+try:
+    import ijson
+    # The pure-Python backend is slower than json.load(), so only use yajl2_c
+    ijson = ijson.get_backend("yajl2_c")
+except ImportError:
+    ijson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Log functions (which should start doing syslog one day)
 
 def log_debug(msg):
@@ -37,163 +58,238 @@ def shell_escape(arg):
 def shell_join(args):
     return " ".join(map(shell_escape, args))
 
+_mac_strip = str.maketrans("", "", ":-")
+
 def canon_mac(mac):
+    if len(mac) == 17:
+        return bytes.fromhex(mac.translate(_mac_strip)).hex(":")
+    # snmpwalk and some arp(8) versions don't zero-pad the octets
     return ":".join(["%02x" % int(i, 16) for i in mac.split(":")])
 
+# Database functions
+
+# executemany() expands this into a single multi-row INSERT per batch, so the
+# server parses it once per batch rather than once per row.
+_insert_sql = """INSERT INTO arplog (ip_addr, mac_addr, first_seen, last_seen)
+                 VALUES (%s, %s, %s, %s)
+                 ON DUPLICATE KEY UPDATE last_seen=VALUES(last_seen)"""
+
+def db_insert_rows(cursor, rows, batch=500):
+    for i in range(0, len(rows), batch):
+        cursor.executemany(_insert_sql, rows[i:i+batch])
+
+def db_stage_rows(cursor, rows):
+    with tempfile.NamedTemporaryFile("w", prefix="ndplog.", suffix=".tsv") as f:
+        f.writelines(["%s\t%s\t%r\t%r\n" % row for row in rows])
+        f.flush()
+        cursor.execute("""LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE arplog_stage
+                          FIELDS TERMINATED BY '\\t'
+                          (ip_addr, mac_addr, first_seen, last_seen)""",
+                       (f.name,))
+
+def db_merge_staged(cursor):
+    cursor.execute("""INSERT INTO arplog (ip_addr, mac_addr, first_seen, last_seen)
+                      SELECT ip_addr, mac_addr, first_seen, last_seen FROM arplog_stage
+                      ON DUPLICATE KEY UPDATE last_seen=VALUES(last_seen)""")
+    cursor.execute("DELETE FROM arplog_stage")
+
+Neigh = collections.namedtuple("Neigh", ["ip", "mac", "dev", "af"])
+
 class NeighbourTable():
+    # Set if the table already yields lowercase MAC addresses
+    mac_is_canonical = False
+
     def get_all(self):
         yield from self.get_arp4()
         yield from self.get_ndp6()
 
 class _SshNeighbourTable(NeighbourTable):
+    # Subclasses set _arp4_cmd/_ndp6_cmd and implement _parse_arp4/_parse_ndp6
+    text_output = True
+
     def __init__(self, host=None):
         if host and host != "-":
             self.host = host
         else:
             self.host = None
 
+    def _ssh_args(self):
+        # Share one connection between the ARP and ND commands
+        return ["ssh",
+                "-o", "ControlMaster=auto",
+                "-o", "ControlPath=~/.ssh/ndplog-%C",
+                "-o", "ControlPersist=30s",
+                self.host]
+
     def _popen(self, args):
         if self.host:
-            return subprocess.Popen(["ssh", self.host, shell_join(args)],
-                                    stdout=subprocess.PIPE)
+            args = self._ssh_args() + [shell_join(args)]
+        if self.text_output:
+            return subprocess.Popen(args, stdout=subprocess.PIPE,
+                                    encoding="utf-8", errors="replace",
+                                    bufsize=1 << 20)
         else:
-            return subprocess.Popen(args, stdout=subprocess.PIPE)
+            return subprocess.Popen(args, stdout=subprocess.PIPE,
+                                    bufsize=1 << 20)
+
+    def _ssh_connect(self):
+        # Open the master connection up front; if both commands were started
+        # without one, each would make its own connection and neither would
+        # be shared. ControlPersist keeps it around after 'true' exits.
+        proc = subprocess.run(self._ssh_args() + ["true"],
+                              stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL)
+        if proc.returncode != 0:
+            raise IOError("command %r returned %r" % (proc.args, proc.returncode))
+
+    def _wait(self, proc):
+        if proc.wait() != 0:
+            raise IOError("command %r returned %r" % (proc.args, proc.returncode))
 
-class LinuxNeighbourTable(_SshNeighbourTable):
-    def _parse_neigh(self, io):
-        for line in io:
-            line = line.strip().decode("utf-8").split()
-            ip = mac = dev = None
-            i = 0
-            while i < len(line):
-                if i == 0:
-                    ip = line[i]
-                elif line[i] == "dev":
-                    dev = line[i+1]
-                    i += 1
-                elif line[i] == "lladdr":
-                    mac = line[i+1]
-                    i += 1
-                else:
-                    pass
-                i += 1
-            if ip and mac:
-                yield {
-                    "ip": ip,
-                    "mac": mac,
-                    "dev": dev,
-                }
+    def get_all(self):
+        # Start both commands at once, so that the second one is already
+        # running while the first one's output is being read
+        if self.host:
+            self._ssh_connect()
+        with self._popen(self._arp4_cmd) as p4, self._popen(self._ndp6_cmd) as p6:
+            yield from self._parse_arp4(p4.stdout)
+            self._wait(p4)
+            yield from self._parse_ndp6(p6.stdout)
+            self._wait(p6)
 
     def get_arp4(self):
-        with self._popen(["ip", "-4", "neigh"]) as proc:
-            yield from self._parse_neigh(proc.stdout)
-            if proc.wait() != 0:
-                raise IOError("command %r returned %r" % (proc.args, proc.returncode))
+        with self._popen(self._arp4_cmd) as proc:
+            yield from self._parse_arp4(proc.stdout)
+            self._wait(proc)
 
     def get_ndp6(self):
-        with self._popen(["ip", "-6", "neigh"]) as proc:
-            yield from self._parse_neigh(proc.stdout)
-            if proc.wait() != 0:
-                raise IOError("command %r returned %r" % (proc.args, proc.returncode))
+        with self._popen(self._ndp6_cmd) as proc:
+            yield from self._parse_ndp6(proc.stdout)
+            self._wait(proc)
+
+_neigh_re = re.compile(rb"^(?P<ip>\S+)"
+                       rb"(?:(?=.* dev (?P<dev>\S+)))?"
+                       rb"(?=.* lladdr (?P<mac>\S+))")
+
+class LinuxNeighbourTable(_SshNeighbourTable):
+    mac_is_canonical = True
+    text_output = False
+    _arp4_cmd = ["ip", "-4", "neigh"]
+    _ndp6_cmd = ["ip", "-6", "neigh"]
+
+    def _parse_neigh(self, io, af):
+        for line in io:
+            if line.startswith(b"fe80:"):
+                continue
+            m = _neigh_re.match(line)
+            if m:
+                yield Neigh(m["ip"].decode(),
+                            m["mac"].decode(),
+                            m["dev"] and m["dev"].decode(),
+                            af)
+
+    def _parse_arp4(self, io):
+        return self._parse_neigh(io, 4)
+
+    def _parse_ndp6(self, io):
+        return self._parse_neigh(io, 6)
 
 class LinuxNeighbourTableNew(_SshNeighbourTable):
-    def _parse_neigh(self, io):
-        data = json.load(io)
+    mac_is_canonical = True
+    text_output = False
+    _arp4_cmd = ["ip", "-json", "-4", "neigh"]
+    _ndp6_cmd = ["ip", "-json", "-6", "neigh"]
+
+    def _load_json(self, io):
+        if simdjson:
+            # Fields are only decoded when accessed; use a fresh parser as the
+            # returned document is only valid until the parser is reused.
+            return simdjson.Parser().parse(io.read())
+        elif orjson:
+            return orjson.loads(io.read())
+        elif ijson:
+            # Parses incrementally, so the whole output and all of its dicts
+            # are never held at once. Rows are still collected per host by
+            # poll_host(), so this only saves parser memory, not insert latency.
+            return ijson.items(io, "item")
+        else:
+            return json.load(io)
+
+    def _parse_neigh(self, io, af):
+        data = self._load_json(io)
         for row in data:
             ip = row.get("dst")
             mac = row.get("lladdr")
             dev = row.get("dev")
-            if ip and mac:
-                yield {
-                    "ip": ip,
-                    "mac": mac,
-                    "dev": dev,
-                }
+            if ip and mac and not ip.startswith("fe80:"):
+                yield Neigh(ip, mac, dev, af)
 
-    def get_arp4(self):
-        with self._popen(["ip", "-json", "-4", "neigh"]) as proc:
-            yield from self._parse_neigh(proc.stdout)
-            if proc.wait() != 0:
-                raise IOError("command %r returned %r" % (proc.args, proc.returncode))
+    def _parse_arp4(self, io):
+        return self._parse_neigh(io, 4)
 
-    def get_ndp6(self):
-        with self._popen(["ip", "-json", "-6", "neigh"]) as proc:
-            yield from self._parse_neigh(proc.stdout)
-            if proc.wait() != 0:
-                raise IOError("command %r returned %r" % (proc.args, proc.returncode))
+    def _parse_ndp6(self, io):
+        return self._parse_neigh(io, 6)
 
 class FreeBsdNeighbourTable(_SshNeighbourTable):
-    def get_arp4(self):
-        with self._popen(["arp", "-na"]) as proc:
-            for line in proc.stdout:
-                line = line.strip().decode("utf-8").split()
-                if line[3] == "(incomplete)":
-                    continue
-                assert(line[0] == "?")
-                assert(line[2] == "at")
-                assert(line[4] == "on")
-                yield {
-                    "ip": line[1].strip("()"),
-                    "mac": line[3],
-                    "dev": line[5],
-                }
-            if proc.wait() != 0:
-                raise IOError("command %r returned %r" % (proc.args, proc.returncode))
+    _arp4_cmd = ["arp", "-na"]
+    _ndp6_cmd = ["ndp", "-na"]
 
-    def get_ndp6(self):
-        with self._popen(["ndp", "-na"]) as proc:
-            for line in proc.stdout:
-                line = line.strip().decode("utf-8").split()
-                if line[0] != "Neighbor":
-                    assert(":" in line[0])
-                    yield {
-                        "ip": line[0],
-                        "mac": line[1],
-                        "dev": line[2],
-                    }
-            if proc.wait() != 0:
-                raise IOError("command %r returned %r" % (proc.args, proc.returncode))
+    def _parse_arp4(self, io):
+        for line in io.read().splitlines():
+            line = line.split()
+            if line[3] == "(incomplete)":
+                continue
+            assert(line[0] == "?")
+            assert(line[2] == "at")
+            assert(line[4] == "on")
+            yield Neigh(line[1].strip("()"),
+                        line[3],
+                        line[5],
+                        4)
+
+    def _parse_ndp6(self, io):
+        for line in io.read().splitlines():
+            line = line.split()
+            if line[0].startswith("fe80:"):
+                continue
+            if line[0] != "Neighbor":
+                assert(":" in line[0])
+                yield Neigh(line[0], line[1], line[2], 6)
 
 class SolarisNeighbourTable(_SshNeighbourTable):
-    def get_arp4(self):
-        with self._popen(["arp", "-na"]) as proc:
-            header = True
-            for line in proc.stdout:
-                line = line.strip().decode("utf-8").split()
-                if not line:
-                    pass
-                elif header:
-                    if line[0].startswith("-"):
-                        header = False
-                else:
-                    yield {
-                        "ip": line[1],
-                        "mac": line[3] if ":" in line[3] else line[4],
-                        "dev": line[0],
-                    }
-            if proc.wait() != 0:
-                raise IOError("command %r returned %r" % (proc.args, proc.returncode))
-
-    def get_ndp6(self):
-        with self._popen(["netstat", "-npf", "inet6"]) as proc:
-            header = True
-            for line in proc.stdout:
-                line = line.strip().decode("utf-8").split()
-                if not line:
-                    pass
-                elif header:
-                    if line[0].startswith("-"):
-                        header = False
-                else:
-                    yield {
-                        "ip": line[4],
-                        "mac": line[1],
-                        "dev": line[0],
-                    }
-            if proc.wait() != 0:
-                raise IOError("command %r returned %r" % (proc.args, proc.returncode))
+    _arp4_cmd = ["arp", "-na"]
+    _ndp6_cmd = ["netstat", "-npf", "inet6"]
+
+    def _parse_arp4(self, io):
+        header = True
+        for line in io.read().splitlines():
+            line = line.split()
+            if not line:
+                pass
+            elif header:
+                if line[0].startswith("-"):
+                    header = False
+            else:
+                yield Neigh(line[1],
+                            line[3] if ":" in line[3] else line[4],
+                            line[0],
+                            4)
+
+    def _parse_ndp6(self, io):
+        header = True
+        for line in io.read().splitlines():
+            line = line.split()
+            if not line:
+                pass
+            elif header:
+                if line[0].startswith("-"):
+                    header = False
+            elif not line[4].startswith("fe80:"):
+                yield Neigh(line[4], line[1], line[0], 6)
 
 class RouterOsNeighbourTable(NeighbourTable):
+    mac_is_canonical = True
+
     def __init__(self, host, username="admin", password=""):
         self.host = host
         self.username = username
@@ -219,25 +315,27 @@ class RouterOsNeighbourTable(NeighbourTable):
         for i in self.api.talk(["/ip/arp/getall"]).values():
             if "mac-address" not in i:
                 continue
-            yield {
-                "ip": i["address"],
-                "mac": i["mac-address"],
-                "dev": i["interface"],
-            }
+            yield Neigh(i["address"],
+                        i["mac-address"].lower(),
+                        i["interface"],
+                        4)
 
     def get_ndp6(self):
         for i in self.api.talk(["/ipv6/neighbor/getall"]).values():
             if "mac-address" not in i:
                 continue
-            yield {
-                "ip": i["address"],
-                "mac": i["mac-address"],
-                "dev": i["interface"],
-            }
+            if i["address"].startswith("fe80:"):
+                continue
+            yield Neigh(i["address"],
+                        i["mac-address"].lower(),
+                        i["interface"],
+                        6)
 
 class SnmpNeighbourTable(NeighbourTable):
     AF_INET = 1
     AF_INET6 = 2
+    IFNAME_CACHE_TTL = 3600
+    mac_is_canonical = True
 
     def __init__(self, host, community="public"):
         self.host = host
@@ -248,41 +346,80 @@ class SnmpNeighbourTable(NeighbourTable):
         }
 
     def _walk(self, mib):
-        with self._popen(["snmpbulkwalk", "-v2c",
-                          "-c%s" % self.community,
-                          "-Onq",
-                          self.host, mib]) as proc:
-            for line in proc.stdout:
-                line = line.strip().decode("utf-8").split()
-                oid = line[0].split(".")
-                value = line[1]
-                yield oid, value
+        with subprocess.Popen(["snmpbulkwalk", "-v2c",
+                               "-c%s" % self.community,
+                               "-Onq",
+                               self.host, mib],
+                              stdout=subprocess.PIPE) as proc:
+            out = proc.stdout.read()
             if proc.wait() != 0:
                 raise IOError("command %r returned %r" % (proc.args, proc.returncode))
-
-    def get_all(self, only_af=None):
-        if only_af and self._cache[only_af]:
-            yield from self._cache[only_af]
+        # OIDs are only ever passed to int(), so keep everything as bytes
+        for line in out.splitlines():
+            oid, _, value = line.partition(b" ")
+            yield oid.split(b"."), value
+
+    def _ifname_cache_path(self):
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        return os.path.join(cache_dir, "ndplog", "ifname-%s.pkl" % self.host)
+
+    def _get_ifnames(self):
+        path = self._ifname_cache_path()
+        try:
+            if os.path.getmtime(path) > time.time() - self.IFNAME_CACHE_TTL:
+                with open(path, "rb") as f:
+                    return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
 
         idx2name = {}
         for oid, value in self._walk("IF-MIB::ifName"):
             ifindex = int(oid[12])
-            idx2name[ifindex] = value
+            idx2name[ifindex] = value.decode("utf-8", "replace")
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                pickle.dump(idx2name, f)
+        except OSError as e:
+            log_debug("Could not write cache %r: %r" % (path, e))
+        return idx2name
+
+    def _forget_ifnames(self):
+        try:
+            os.unlink(self._ifname_cache_path())
+        except FileNotFoundError:
+            pass
 
-        for oid, value in self._walk("IP-MIB::ipNetToPhysicalPhysAddress"):
-            ifindex = int(oid[11])
-            af = int(oid[12])
-            if af not in self._cache:
-                continue
-            addr = bytes([int(c) for c in oid[14:]])
-            item = {
-                "ip": ipaddress.ip_address(addr),
-                "mac": canon_mac(value),
-                "dev": idx2name.get(ifindex, ifindex),
-            }
-            self._cache[af].append(item)
-            if not only_af or only_af == af:
-                yield item
+    def get_all(self, only_af=None):
+        if only_af and self._cache[only_af]:
+            yield from self._cache[only_af]
+
+        idx2name = self._get_ifnames()
+        try:
+            for oid, value in self._walk("IP-MIB::ipNetToPhysicalPhysAddress"):
+                ifindex = int(oid[11])
+                af = int(oid[12])
+                if af not in self._cache:
+                    continue
+                addr = bytes(map(int, oid[14:]))
+                if af == self.AF_INET6 and addr[:2] == b"\xfe\x80":
+                    continue
+                if af == self.AF_INET:
+                    family, version = socket.AF_INET, 4
+                else:
+                    family, version = socket.AF_INET6, 6
+                item = Neigh(socket.inet_ntop(family, addr),
+                             canon_mac(value.decode()),
+                             idx2name.get(ifindex, ifindex),
+                             version)
+                self._cache[af].append(item)
+                if not only_af or only_af == af:
+                    yield item
+        except IOError:
+            # interfaces may have been renumbered; don't trust the cache
+            self._forget_ifnames()
+            raise
 
     def get_arp4(self):
         yield from self.get_all(only_af=self.AF_INET)
@@ -292,11 +429,31 @@ class SnmpNeighbourTable(NeighbourTable):
 
 _systems = {
     "linux": LinuxNeighbourTable,
+    "linux-json": LinuxNeighbourTableNew,
     "bsd": FreeBsdNeighbourTable,
     "solaris": SolarisNeighbourTable,
     "routeros": RouterOsNeighbourTable,
 }
 
+def poll_host(conn_type, host, *conn_args):
+    log_info("Connecting to %s [%s]" % (conn_type, host))
+    n_arp = n_ndp = 0
+    nt = _systems[conn_type](host, *conn_args)
+    now = time.time()
+    rows = []
+    for item in nt.get_all():
+        ip = item.ip.split("%")[0]
+        mac = item.mac if nt.mac_is_canonical else item.mac.lower()
+        log_debug("Found %s -> %s" % (ip, mac))
+        if item.af == 6:
+            n_ndp += 1
+        else:
+            n_arp += 1
+        rows.append((ip, mac, now, now))
+    return now, rows, n_arp, n_ndp
+
+_db_url_re = re.compile(r"^mysql://([^:]+):([^@]+)@([^/]+)/(.+)")
+
 parser = argparse.ArgumentParser()
 parser.add_argument("-c", "--config",
                     default="/etc/ndplog.conf",
@@ -309,20 +466,39 @@ args = parser.parse_args()
 db_url = None
 hosts = []
 max_age_days = 6*30
+bulk_load = False
 verbose = args.verbose
 
+def _config_db(v):
+    global db_url
+    db_url = v
+
+def _config_host(v):
+    hosts.append([_.strip() for _ in v.split(",")])
+
+def _config_age(v):
+    global max_age_days
+    max_age_days = int(v)
+
+def _config_bulk(v):
+    global bulk_load
+    bulk_load = v.lower() in {"1", "yes", "true", "on"}
+
+_config_keys = {
+    "db": _config_db,
+    "host": _config_host,
+    "age": _config_age,
+    "bulk": _config_bulk,
+}
+
 with open(args.config, "r") as f:
     for line in f:
-        if line.startswith("#"):
+        line = line.strip()
+        if not line or line.startswith("#"):
             continue
-        k, v = line.strip().split(" = ", 1)
-        if k == "db":
-            db_url = v
-        elif k == "host":
-            v = [_.strip() for _ in v.split(",")]
-            hosts.append(v)
-        elif k == "age":
-            max_age_days = int(v)
+        k, v = line.split(" = ", 1)
+        if k in _config_keys:
+            _config_keys[k](v)
         else:
             log_error("Unrecognized config key %r" % k)
 
@@ -330,45 +506,51 @@ if not db_url:
     log_error("Database URL not configured")
     exit(2)
 
-m = re.match(r"^mysql://([^:]+):([^@]+)@([^/]+)/(.+)", db_url)
+m = _db_url_re.match(db_url)
 if not m:
     log_error("Unrecognized database URL %r" % db_url)
     exit(2)
 
+# Start polling right away; the database is only needed once results arrive.
+pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(32, len(hosts))))
+futures = {pool.submit(poll_host, *h): h[1] for h in hosts}
+
+conn_opts = {}
+if bulk_load:
+    if MySQLdb.__name__ == "mysql.connector":
+        conn_opts["allow_local_infile"] = True
+    else:
+        conn_opts["local_infile"] = 1
+
 conn = MySQLdb.connect(host=m.group(3),
                        user=m.group(1),
                        password=m.group(2),
-                       database=m.group(4))
+                       database=m.group(4),
+                       autocommit=False,
+                       **conn_opts)
+
+cursor = conn.cursor()
+if bulk_load:
+    cursor.execute("CREATE TEMPORARY TABLE arplog_stage LIKE arplog")
 
 errors = 0
-for conn_type, host, *conn_args in hosts:
-    log_info("Connecting to %s [%s]" % (conn_type, host))
-    n_arp = n_ndp = 0
+for future in concurrent.futures.as_completed(futures):
+    host = futures[future]
     try:
-        nt = _systems[conn_type](host, *conn_args)
-        now = time.time()
-        for item in nt.get_all():
-            ip = item["ip"].split("%")[0]
-            mac = item["mac"].lower()
-            if ip.startswith("fe80:"):
-                log_debug("Skipping link-local ip=%r mac=%r" % (ip, mac))
-                continue
-            log_debug("Found %s -> %s" % (ip, mac))
-            if ":" in ip:
-                n_ndp += 1
-            else:
-                n_arp += 1
-            cursor = conn.cursor()
-            log_debug("Inserting ip=%r mac=%r now=%r" % (ip, mac, now))
-            cursor.execute("""INSERT INTO arplog (ip_addr, mac_addr, first_seen, last_seen)
-                              VALUES (%(ip_addr)s, %(mac_addr)s, %(now)s, %(now)s)
-                              ON DUPLICATE KEY UPDATE last_seen=%(now)s""",
-                           {"ip_addr": ip, "mac_addr": mac, "now": now})
+        now, rows, n_arp, n_ndp = future.result()
     except IOError as e:
         log_error("Connection to %r failed: %r" % (host, e))
         errors += 1
+        continue
+    log_debug("Inserting %d rows for now=%r" % (len(rows), now))
+    if bulk_load:
+        db_stage_rows(cursor, rows)
+        db_merge_staged(cursor)
+    else:
+        db_insert_rows(cursor, rows)
+    conn.commit()
     log_info("[%s] Logged %d ARP entries, %d NDP entries" % (host, n_arp, n_ndp))
-conn.commit()
+pool.shutdown()
 
 if errors:
     log_error("Some hosts couldn't be scanned, exiting without cleanup")
@@ -376,7 +558,6 @@ if errors:
 
 log_info("Cleaning up records more than %d days old" % max_age_days)
 max_age_secs = max_age_days*86400
-cursor = conn.cursor()
 cursor.execute("DELETE FROM arplog WHERE last_seen < %(then)s",
                {"then": time.time() - max_age_secs})
 conn.commit()